@@ -1,15 +1,25 @@
 import os
+import re
 import logging
+import sqlite3
+import random
 import asyncio
-import requests
+import orjson
+import aiohttp
 from telegram import Bot
-from fnmatch import fnmatch
-from bs4 import BeautifulSoup
+from telegram.request import HTTPXRequest
+from fnmatch import translate
+from typing import Any
 from dataclasses import dataclass
-from huggingface_hub import HfApi
+from huggingface_hub import HfApi, ModelInfo
 from argparse import ArgumentParser
 from collections import defaultdict
 from datetime import datetime, timedelta, timezone
+try:
+    # uvloop's event loop is faster than asyncio's default, but it isn't available on Windows
+    from uvloop import run as run_event_loop
+except ImportError:
+    from asyncio import run as run_event_loop
 
 
 BOT_TOKEN = os.environ['BOT_TOKEN']
@@ -20,6 +30,7 @@ logger = logging.getLogger("models-watcher")
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 hf_api = HfApi()
+bot = Bot(token=BOT_TOKEN, request=HTTPXRequest(connection_pool_size=8, http_version="2"))
 
 
 @dataclass
@@ -35,10 +46,118 @@ class Model:
     author: str
     files: list[ModelFile]
     is_new: bool
-
-
-def get_top_organizations(max_orgs: int = 100) -> list[str]:
-    models = hf_api.list_models(sort='trending_score', direction=-1, limit=max_orgs * 5, full=True)
+    last_modified: datetime
+
+
+async def fetch(session: aiohttp.ClientSession, 
+                semaphore: asyncio.Semaphore, 
+                url: str, 
+                *, 
+                max_retries: int = 5
+                ) -> tuple[Any, str | None]:
+    RETRY_STATUSES = {429, 502, 503, 504}
+
+    async with semaphore:
+        for attempt in range(max_retries + 1):
+            try:
+                async with session.get(url) as response:
+                    if response.status not in RETRY_STATUSES or attempt == max_retries:
+                        response.raise_for_status()
+                        next_page = response.links.get('next', {}).get('url')
+                        return await response.json(loads=orjson.loads), str(next_page) if next_page else None
+                    failure = f"status {response.status}"
+                    retry_after = response.headers.get('Retry-After', '')
+            
+            # Dropped connections and read timeouts are as transient as the retried statuses
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == max_retries:
+                    raise
+                failure = f"{e.__class__.__name__}: {e}"
+                retry_after = ''
+
+            # Hugging Face tells us how long to wait when rate-limiting, otherwise back off exponentially with jitter
+            backoff = min(60, float(retry_after) if retry_after.isdigit() else 2 ** attempt + random.random())
+            logger.warning(f"Got {failure} from {url}, retrying in {backoff:.1f}s ({attempt + 1}/{max_retries})")
+            # The semaphore slot is held while backing off, so a burst of rate-limited 
+            # responses lowers the effective concurrency of the whole crawl
+            await asyncio.sleep(backoff)
+
+
+def open_cache(path: str) -> sqlite3.Connection:
+    cache = sqlite3.connect(path)
+    cache.execute("PRAGMA journal_mode=WAL")
+    cache.execute("CREATE TABLE IF NOT EXISTS models (model_id TEXT PRIMARY KEY, last_modified INTEGER, files_json TEXT)")
+    cache.execute("CREATE TABLE IF NOT EXISTS authors (author TEXT PRIMARY KEY, is_org INTEGER)")
+    cache.execute("CREATE TABLE IF NOT EXISTS reported (model_id TEXT PRIMARY KEY, last_modified INTEGER)")
+    return cache
+
+
+def cache_timestamp(time: datetime) -> int:
+    return int(time.timestamp() * 1000)
+
+
+def load_cached_authors(cache: sqlite3.Connection) -> dict[str, bool]:
+    return {author: bool(is_org) for author, is_org in cache.execute("SELECT author, is_org FROM authors")}
+
+
+def save_cached_authors(cache: sqlite3.Connection, authors: dict[str, bool]):
+    with cache:
+        cache.executemany("INSERT OR REPLACE INTO authors (author, is_org) VALUES (?, ?)", authors.items())
+
+
+def load_cached_files(cache: sqlite3.Connection, model: ModelInfo) -> list[ModelFile] | None:
+    row = cache.execute("SELECT last_modified, files_json FROM models WHERE model_id = ?", (model.id,)).fetchone()
+    # Cached files are only valid if the model was not modified since they were fetched
+    if row is None or row[0] != cache_timestamp(model.last_modified):
+        return None
+    return [ModelFile(filename=f['filename'], is_directory=f['is_directory'], change_time=datetime.fromisoformat(f['change_time']))
+            for f in orjson.loads(row[1])]
+
+
+def save_cached_files(cache: sqlite3.Connection, models_files: list[tuple[ModelInfo, list[ModelFile]]], time_threshold: datetime):
+    # orjson serializes the ModelFile dataclasses and their datetimes natively
+    rows = [(model.id, cache_timestamp(model.last_modified), orjson.dumps(files).decode())
+            for model, files in models_files]
+    with cache:
+        cache.executemany("INSERT OR REPLACE INTO models (model_id, last_modified, files_json) VALUES (?, ?, ?)", rows)
+        # Rows last modified before the look-back window can never be hit again, 
+        # neither as cached trees nor as already reported models
+        cache.execute("DELETE FROM models WHERE last_modified < ?", (cache_timestamp(time_threshold),))
+        cache.execute("DELETE FROM reported WHERE last_modified < ?", (cache_timestamp(time_threshold),))
+
+
+def was_reported(cache: sqlite3.Connection, model: ModelInfo) -> bool:
+    row = cache.execute("SELECT last_modified FROM reported WHERE model_id = ?", (model.id,)).fetchone()
+    return row is not None and row[0] == cache_timestamp(model.last_modified)
+
+
+def save_reported(cache: sqlite3.Connection, models: list[Model]):
+    with cache:
+        cache.executemany("INSERT OR REPLACE INTO reported (model_id, last_modified) VALUES (?, ?)", 
+                          [(model.model_id, cache_timestamp(model.last_modified)) for model in models])
+
+
+async def is_organization(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, author: str) -> bool | None:
+    # Only users have an overview, so a 404 means the author is an organization
+    try:
+        await fetch(session, semaphore, f"https://huggingface.co/api/users/{author}/overview")
+        return False
+    except Exception as e:
+        if isinstance(e, aiohttp.ClientResponseError) and e.status == 404:
+            return True
+        logger.error(f'Error checking if {author} is an organization - {e.__class__.__name__}: {e}')
+        return None
+
+
+async def get_top_organizations(session: aiohttp.ClientSession, 
+                                semaphore: asyncio.Semaphore, 
+                                cache: sqlite3.Connection, 
+                                max_orgs: int = 100
+                                ) -> list[str]:
+    # Listing is a blocking paginated call, so it runs in a worker thread to keep the event loop free
+    models = await asyncio.to_thread(
+        lambda: list(hf_api.list_models(sort='trending_score', direction=-1, limit=max_orgs * 5, expand=['author', 'downloads']))
+    )
     author_stats = defaultdict(lambda: {'model_count': 0, 'total_downloads': 0})
     for model in models:
         author = model.author
@@ -46,168 +165,239 @@ def get_top_organizations(max_orgs: int = 100) -> list[str]:
         author_stats[author]['model_count'] += 1
         author_stats[author]['total_downloads'] += downloads
     sorted_authors = sorted(author_stats.items(), key=lambda x: x[1]['total_downloads'], reverse=True)
-    top_authors: list[str] = [author for author, _ in sorted_authors]
-    
+    top_authors: list[str] = [author for author, _ in sorted_authors if author]
+
+    # Authors are checked in rank order, in batches no larger than the number of organizations still needed,
+    # so probing stops as soon as enough organizations were found. Authors seen in previous runs are taken 
+    # from the cache, the rest of each batch is probed concurrently
+    is_org = load_cached_authors(cache)
+    probed: dict[str, bool] = {}
     top_orgs: list[str] = []
-    for author in top_authors:
-        try: 
-            hf_api.get_user_overview(author, token=False)
-            continue
-        except:
-            top_orgs.append(author)
-        finally:
-            if len(top_orgs) >= max_orgs:
-                break
+    checked = 0
+    while len(top_orgs) < max_orgs and checked < len(top_authors):
+        batch = top_authors[checked:checked + max_orgs - len(top_orgs)]
+        checked += len(batch)
+        unknown_authors = [author for author in batch if author not in is_org]
+        probes = await asyncio.gather(*[is_organization(session, semaphore, author) for author in unknown_authors])
+        batch_probed = {author: result for author, result in zip(unknown_authors, probes) if result is not None}
+        probed.update(batch_probed)
+        is_org.update(batch_probed)
+        # Authors that couldn't be checked are kept, as failing to find a user overview always meant an organization
+        top_orgs.extend(author for author in batch if is_org.get(author, True))
+    save_cached_authors(cache, probed)
 
     logger.info(f"Retrieved {len(top_orgs)} top organizations from hugging-face:\n{top_orgs}")
     return top_orgs
 
 
-def find_model_files(model_id: str) -> list[ModelFile]:
-    FILES_TO_IGNORE = ['.git*', '*.md', 'config.json']
+# Glob patterns of files to ignore, compiled once into a single regex
+FILES_TO_IGNORE = re.compile('|'.join(translate(pattern) for pattern in ['.git*', '*.md', 'config.json']))
 
-    response = requests.get(f"https://huggingface.co/{model_id}/tree/main")
-    response.raise_for_status()
-    soup = BeautifulSoup(response.content, "html.parser")
-    modified_files: list[ModelFile] = []
 
-    # This section looks into the model repository page. 
-    # The <ul> tag examined here is the table seen on the page, 
-    # and each <li> is a list in the table
-    for ul in soup.find_all("ul"):
-
-        # Only one <ul> has <time> tags in it, which are the last modified times of the files. 
-        # This is the table we're looking for
-        if ul.find_all("time"):
+async def find_model_files(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, model_id: str) -> list[ModelFile]:
+    # The tree endpoint lists the top-level entries of the repository (the same data HfApi.list_repo_tree wraps),
+    # and with `expand` it also reports the last commit that touched each of them. 
+    # Expanded listings are paginated, so we follow the next-page links until there are none left
+    url: str | None = f"https://huggingface.co/api/models/{model_id}/tree/main?expand=true"
+    modified_files: list[ModelFile] = []
+    while url:
+        entries, url = await fetch(session, semaphore, url)
+        for entry in entries:
+            try:
+                filename: str = entry['path']
+                if FILES_TO_IGNORE.match(filename): continue
+                is_directory = entry['type'] == 'directory'
+                change_time = datetime.fromisoformat(entry['lastCommit']['date'])
+                modified_files.append(ModelFile(filename=filename, is_directory=is_directory, change_time=change_time))
             
-            for li in ul.find_all("li"):
-                try:
-                    # First <a> tag in <li> is the filename
-                    filename: str = li.find("a").get_text(strip=True)  
-                    if any(fnmatch(filename, pattern) for pattern in FILES_TO_IGNORE): continue
-                    # the first <svg> is the icon next to the filename. 
-                    # If it has the class "text-blue", it's a directory icon.
-                    is_directory = any(['text-blue' in c for c in li.find("svg").get("class")]) 
-                    # The <time> tag is the last modified time of the file
-                    change_time = datetime.strptime(li.find("time").get("datetime"), "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
-                    modified_files.append(ModelFile(filename=filename, is_directory=is_directory, change_time=change_time))
-                
-                except Exception as e:
-                    logger.error(f'Error analyzing file from repo webpage - {e.__class__.__name__}: {e}\n{li}')
+            except Exception as e:
+                logger.error(f'Error analyzing file from repo tree - {e.__class__.__name__}: {e}\n{entry}')
 
     return modified_files
 
 
-def find_new_models(time_threshold: datetime, top_orgs: list[str]) -> list[Model]:
-    models = hf_api.list_models(sort="created_at", direction=-1, full=True)
-    recent_models: list[Model] = []
-    for model in models:
-        if model.created_at is None:
-            continue
-        elif model.created_at >= time_threshold:
-            if model.author in top_orgs:
-                recent_models.append(Model(model_id=model.id, author=model.author, files=[], is_new=True))
-        else:
-            break  
-    logger.info(f"Found {len(recent_models)} new models on hugging-face")
-    return recent_models
-
-
-def find_modified_models(time_threshold: datetime, top_orgs: list[str]) -> list[Model]:
-    models = hf_api.list_models(sort="last_modified", direction=-1, full=True)
-    recent_models: list[Model] = []  
+def list_recently_modified_models(time_threshold: datetime) -> list[ModelInfo]:
+    # A model's creation time is never later than its last modification time, so a single scan 
+    # sorted by last modification covers both the new and the modified models.
+    # Only the fields we read are expanded, rather than the full model metadata
+    models = hf_api.list_models(sort="last_modified", direction=-1, expand=["author", "createdAt", "lastModified"])
+    recently_modified: list[ModelInfo] = []
     for model in models:
         if model.last_modified is None or model.created_at is None:
             continue
         elif model.last_modified >= time_threshold:
-            if model.created_at < time_threshold:
-                if model.author in top_orgs:
-                    files = find_model_files(model.id)
-                    if any(f.change_time >= time_threshold for f in files):
-                        recent_models.append(
-                            Model(
-                                model_id=model.id,
-                                author=model.author, 
-                                files=files,
-                                is_new=all(f.change_time >= time_threshold for f in files)
-                            )
-                        )
+            recently_modified.append(model)
         else:
             break  
-    logger.info(f"Found {len(recent_models)} modified models on hugging-face")
-    return recent_models
-
-
-def escape_markdown(text: str, 
-                    *, 
-                    chars: list[str] = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-                    ) -> str:
-    for char in chars:
-        text = text.replace(char, f"\\{char}")
-    return text
-
-
-def prepare_message(time_threshold: datetime) -> str:
-    top_orgs = get_top_organizations()
-    new_models = find_new_models(time_threshold, top_orgs)
-    all_modified_models = find_modified_models(time_threshold, top_orgs)
+    return recently_modified
+
+
+async def find_recent_models(session: aiohttp.ClientSession, 
+                             semaphore: asyncio.Semaphore, 
+                             time_threshold: datetime, 
+                             top_orgs: frozenset[str], 
+                             recently_modified: list[ModelInfo],
+                             cache: sqlite3.Connection
+                             ) -> list[Model]:
+    new_models: list[Model] = []
+    candidates: list[ModelInfo] = []
+    for model in recently_modified:
+        # Models already reported by a previous run, and not modified since, are not reported again
+        if model.author in top_orgs and not was_reported(cache, model):
+            if model.created_at >= time_threshold:
+                new_models.append(Model(model_id=model.id, author=model.author, files=[], is_new=True, last_modified=model.last_modified))
+            else:
+                candidates.append(model)
+    logger.info(f"Found {len(new_models)} new models on hugging-face")
+
+    # Trees of models which weren't modified since a previous run are taken from the cache
+    models_files: dict[str, list[ModelFile]] = {}
+    for model in candidates:
+        files = load_cached_files(cache, model)
+        if files is not None:
+            models_files[model.id] = files
+    uncached = [model for model in candidates if model.id not in models_files]
+    logger.info(f"Using cached file trees for {len(models_files)} of {len(candidates)} modified models")
+
+    # A model whose tree couldn't be fetched is logged and skipped, rather than failing the whole run
+    fetched_files = await asyncio.gather(*[find_model_files(session, semaphore, model.id) for model in uncached], return_exceptions=True)
+    fetched: list[tuple[ModelInfo, list[ModelFile]]] = []
+    for model, files in zip(uncached, fetched_files):
+        if isinstance(files, Exception):
+            logger.error(f'Error fetching files of {model.id} - {files.__class__.__name__}: {files}')
+        else:
+            fetched.append((model, files))
+    models_files.update((model.id, files) for model, files in fetched)
 
     modified_models: list[Model] = []
-    for model in all_modified_models:
+    for model in candidates:
+        if model.id not in models_files:
+            continue
+        files = models_files[model.id]
+        # A single pass finds whether any of the files changed (modified model) and whether all of them did (new model)
+        any_changed, all_changed = False, True
+        for f in files:
+            if f.change_time >= time_threshold:
+                any_changed = True
+            else:
+                all_changed = False
+            if any_changed and not all_changed:
+                break
+        if any_changed:
+            modified_models.append(
+                Model(
+                    model_id=model.id,
+                    author=model.author, 
+                    files=files,
+                    is_new=all_changed,
+                    last_modified=model.last_modified
+                )
+            )
+    logger.info(f"Found {len(modified_models)} modified models on hugging-face")
+    save_cached_files(cache, fetched, time_threshold)
+    return new_models + modified_models
+
+
+# Translation tables are built once, so escaping is a single pass over the text
+MARKDOWN_ESCAPES = str.maketrans({char: f"\\{char}" for char in ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']})
+MARKDOWN_URL_ESCAPES = str.maketrans({'(': "\\("})
+
+
+def escape_markdown(text: str) -> str:
+    return text.translate(MARKDOWN_ESCAPES)
+
+
+def escape_markdown_url(text: str) -> str:
+    return text.translate(MARKDOWN_URL_ESCAPES)
+
+
+async def prepare_message(session: aiohttp.ClientSession, 
+                          semaphore: asyncio.Semaphore, 
+                          time_threshold: datetime, 
+                          cache: sqlite3.Connection
+                          ) -> tuple[str, list[Model]]:
+    # The recent models listing doesn't depend on the top organizations, so both are retrieved side by side
+    recently_modified, top_orgs = await asyncio.gather(
+        asyncio.to_thread(list_recently_modified_models, time_threshold),
+        get_top_organizations(session, semaphore, cache)
+    )
+    recent_models = await find_recent_models(session, semaphore, time_threshold, frozenset(top_orgs), recently_modified, cache)
+
+    new_models: list[Model] = []
+    modified_models: list[Model] = []
+    for model in recent_models:
         if model.is_new:
             new_models.append(model)
         else:
             modified_models.append(model)
 
-    message = ""
+    parts: list[str] = []
     if new_models:
         authors = sorted(list(set([model.author for model in new_models])))
-        message += f"🆕 *New models:*\n"
+        parts.append(f"🆕 *New models:*\n")
         for author in authors:
-            message += f"*{escape_markdown(author)}:*\n"
+            parts.append(f"*{escape_markdown(author)}:*\n")
             for model in new_models:
                 if model.author == author:
-                    message += f" • [{escape_markdown(model.model_id)}](https://huggingface.co/{escape_markdown(model.model_id, chars=['('])})\n"
+                    model_link = f"[{escape_markdown(model.model_id)}](https://huggingface.co/{escape_markdown_url(model.model_id)})"
+                    parts.append(f" • {model_link}\n")
     if modified_models:
         authors = sorted(list(set([model.author for model in modified_models])))
-        message += f"\n🔄 *Modified models:*\n"
+        parts.append(f"\n🔄 *Modified models:*\n")
         for author in authors:
-            message += f"*{escape_markdown(author)}:*\n"
+            parts.append(f"*{escape_markdown(author)}:*\n")
             for model in modified_models:
                 if model.author == author:
-                    modified_files = [f"{'Contents of ' if f.is_directory else ''}{f.filename}{'/' if f.is_directory else ''}" 
-                                    for f in model.files if f.change_time >= time_threshold]
-                    modified_files = [escape_markdown(f) for f in modified_files]
-                    message += f" • [{escape_markdown(model.model_id)}](https://huggingface.co/{escape_markdown(model.model_id, chars=['('])}) _\\(Updated files: {', '.join(modified_files)}\\)_\n"
-    return message.strip()
+                    model_link = f"[{escape_markdown(model.model_id)}](https://huggingface.co/{escape_markdown_url(model.model_id)})"
+                    modified_files = [escape_markdown(f"Contents of {f.filename}/" if f.is_directory else f.filename) 
+                                      for f in model.files if f.change_time >= time_threshold]
+                    parts.append(f" • {model_link} _\\(Updated files: {', '.join(modified_files)}\\)_\n")
+    return "".join(parts).strip(), recent_models
 
 
 async def send_group_message(message: str):
-    bot = Bot(token=BOT_TOKEN)
     await bot.send_message(chat_id=GROUP_CHAT_ID, text=message, parse_mode="MarkdownV2")
 
 
+async def watch(time_threshold: datetime, dry_run: bool, cache_file: str):
+    # Requests to hugging-face are made concurrently, the semaphore bounds the number of requests in flight.
+    # The session lives for the whole run, on the same event loop the Telegram bot sends from
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=16, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(sock_connect=5, sock_read=30)
+    semaphore = asyncio.Semaphore(32)
+    cache = open_cache(cache_file)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            message, reported_models = await prepare_message(session, semaphore, time_threshold, cache)
+            if message:
+                logger.info(f"Sending message:\n{message}")
+                if dry_run:
+                    logger.info("ℹ️ DRY RUN MODE ACTIVATED (message will not be sent)")
+                else:
+                    # The bot's connection pool is opened once and closed when leaving the context
+                    async with bot:
+                        await send_group_message(message)
+                    save_reported(cache, reported_models)
+            else:
+                logger.info("No message to send")
+    finally:
+        cache.close()
+
+
 def main():                    
     parser = ArgumentParser()
     parser.add_argument("--days", type=int, default=0, help="Number of days to look back")
     parser.add_argument("--hours", type=int, default=0, help="Number of hours to look back")
     parser.add_argument("--minutes", type=int, default=0, help="Number of minutes to look back")
     parser.add_argument("--dry-run", action='store_true', help='Dry run mode (no message will be sent)', dest='dry_run')
+    parser.add_argument("--cache-file", type=str, default="models_cache.db", help="SQLite file caching models data and reported models between runs", dest='cache_file')
     args = parser.parse_args()
 
     assert any([args.days, args.hours, args.minutes]), "At least one of the time arguments (days/hours/minutes) must be greater than 0"
     delta = timedelta(days=args.days, hours=args.hours, minutes=args.minutes)
     time_threshold = datetime.now(timezone.utc) - delta
 
-    message = prepare_message(time_threshold)
-    if message:
-        logger.info(f"Sending message:\n{message}")
-        if args.dry_run:
-            logger.info("ℹ️ DRY RUN MODE ACTIVATED (message will not be sent)")
-        else:
-            asyncio.run(send_group_message(message))
-    else:
-        logger.info("No message to send")
+    run_event_loop(watch(time_threshold, args.dry_run, args.cache_file))
 
 
 if __name__ == "__main__":